@@ -11,22 +11,43 @@ Note: This is a reasonably complete example but intended as a starting point. In
 """
 
 import os
+import re
+import gzip
 import json
+import math
+import time
 import uuid
-from datetime import datetime, timedelta
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import threading
+import mimetypes
+from collections import Counter, OrderedDict
+from functools import wraps
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 from urllib.parse import urljoin
 
+import click
 from flask import (
-    Flask, render_template, redirect, url_for, flash, request, jsonify, abort, send_from_directory
+    Flask, render_template, redirect, url_for, flash, request, jsonify, abort, send_from_directory,
+    Response, stream_with_context
 )
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, or_, true, select, insert, update, delete, text, case, literal, null
+from sqlalchemy.orm import Session
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
 
+try:
+    import brotli  # optional: enables .br precompression and br response encoding
+except ImportError:
+    brotli = None
+
 # Load environment
 load_dotenv()
 
@@ -44,6 +65,55 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['ALLOWED_IMAGE_EXT'] = {'png', 'jpg', 'jpeg', 'gif'}
 app.config['ALLOWED_AUDIO_EXT'] = {'mp3', 'wav', 'ogg', 'webm'}
 app.config['PUBLIC_URL_ROOT'] = os.getenv('PUBLIC_URL_ROOT', 'http://localhost:5000')
+app.config['ASSET_DIST_DIR'] = 'dist'  # relative to static/, output of `flask build-assets`
+app.config['ASSET_SKIP_DIRS'] = {'dist', 'uploads'}
+app.config['ASSET_PRECOMPRESS_EXT'] = {'css', 'js', 'svg', 'json', 'txt', 'html'}
+app.config['COMPRESS_MIMETYPES'] = {'text/html', 'text/css', 'text/plain', 'application/json', 'application/javascript', 'image/svg+xml'}
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', 500))
+app.config['COMPRESS_LEVEL'] = 6
+app.config['TAILWIND_CDN_URL'] = 'https://cdn.tailwindcss.com'
+# admission control: token bucket (burst, tokens/sec) per user+endpoint, and in-flight caps per group
+app.config['RATE_LIMIT_BACKEND'] = os.getenv('RATE_LIMIT_BACKEND', 'memory')  # 'memory' or 'sqlite'
+app.config['RATE_LIMIT_SQLITE_PATH'] = os.getenv('RATE_LIMIT_SQLITE_PATH', os.path.join(BASE_DIR, 'ratelimit.db'))
+app.config['RATE_LIMITS'] = {
+    'create_entry': (10, 10 / 60),
+    'create_memory': (10, 10 / 60),
+    'api_sync': (5, 5 / 60),
+    'api_entries_batch': (5, 5 / 60),
+    'api_memories_batch': (5, 5 / 60),
+}
+app.config['CONCURRENCY_LIMITS'] = {'upload': 4, 'sync': 2}
+app.config['CONCURRENCY_RETRY_AFTER'] = 2
+app.config['ADMIN_USERNAMES'] = {u.strip() for u in os.getenv('ADMIN_USERNAMES', '').split(',') if u.strip()}
+# retention: rows past these limits move to archive tables ('table') or NDJSON.gz files ('ndjson')
+app.config['RETENTION_ARCHIVE'] = os.getenv('RETENTION_ARCHIVE', 'table')
+app.config['RETENTION_ARCHIVE_DIR'] = os.path.join(BASE_DIR, 'archive')
+app.config['RETENTION_BATCH_SIZE'] = 500
+app.config['RETENTION_VACUUM_PAGES'] = 2000
+app.config['RETENTION_POLICIES'] = {
+    # max_age_days and per_user_cap apply to rows whose done_column is true (every row when it is
+    # None); hard_max_age_days applies to every row. Nothing marks sync logs resolved yet, so their
+    # age limit and cap cover all rows.
+    'sync_logs': {'done_column': None, 'max_age_days': 30, 'hard_max_age_days': 180, 'per_user_cap': 5000},
+    'notifications': {'done_column': 'is_read', 'max_age_days': 60, 'hard_max_age_days': 365, 'per_user_cap': 500},
+}
+# notification push: 'memory' wakes streams in this process, 'poll' checks the DB (multi-worker)
+app.config['NOTIFY_BACKEND'] = os.getenv('NOTIFY_BACKEND', 'memory')
+app.config['NOTIFY_POLL_INTERVAL'] = 2
+app.config['NOTIFY_HEARTBEAT'] = 15
+app.config['NOTIFY_STREAM_MAX_SECONDS'] = 300  # EventSource reconnects afterwards
+app.config['NOTIFY_BATCH_SIZE'] = 50
+app.config['CAPSULE_REVEAL_BATCH_SIZE'] = 500
+# resumable uploads: partial files live outside static/ until finalized
+app.config['UPLOAD_TMP_FOLDER'] = os.path.join(app.instance_path, 'partial_uploads')
+app.config['UPLOAD_MAX_SIZE'] = 200 * 1024 * 1024
+app.config['UPLOAD_CHUNK_SIZE'] = 1024 * 1024  # suggested to clients
+app.config['UPLOAD_MAX_CHUNK'] = 8 * 1024 * 1024
+app.config['UPLOAD_SESSION_TTL'] = timedelta(hours=24)
+app.config['BATCH_MAX_ITEMS'] = 500
+# gazetteer: coordinates within this radius of a known location reuse it instead of adding a row
+app.config['GAZETTEER_RADIUS_M'] = float(os.getenv('GAZETTEER_RADIUS_M', 50))
+app.config['GAZETTEER_CACHE_CELLS'] = 20000
 app.jinja_env.globals['datetime'] = datetime
 
 
@@ -132,7 +202,7 @@ class Memory(db.Model):
     location = db.relationship('Location')
     attachments = db.relationship('Attachment', backref='memory', lazy='dynamic')
     visibility = db.Column(db.String(16), default=Visibility.PRIVATE.value, nullable=False, index=True)
-    capsule_id = db.Column(db.Integer, db.ForeignKey('capsules.id'), nullable=True)
+    capsule_id = db.Column(db.Integer, db.ForeignKey('capsules.id'), nullable=True, index=True)
 
 class Capsule(db.Model):
     __tablename__ = 'capsules'
@@ -144,6 +214,9 @@ class Capsule(db.Model):
     unlock_at = db.Column(db.DateTime, nullable=False, index=True)
     is_revealed = db.Column(db.Boolean, default=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # visibility given to linked entries/memories on reveal: private keeps them as they are
+    reveal_policy = db.Column(db.String(16), default=Visibility.PRIVATE.value, nullable=False)
+    revealed_at = db.Column(db.DateTime, nullable=True)
 
 class Location(db.Model):
     __tablename__ = 'locations'
@@ -153,6 +226,7 @@ class Location(db.Model):
     longitude = db.Column(db.Float, nullable=False)
     precision = db.Column(db.String(64), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_locations_lat_lon', 'latitude', 'longitude'),)
 
 class Reminder(db.Model):
     __tablename__ = 'reminders'
@@ -177,6 +251,13 @@ class Notification(db.Model):
     is_read = db.Column(db.Boolean, default=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     delivered_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (db.Index('ix_notifications_user_delivered', 'user_id', 'delivered_at'),)
+
+class NotificationCounter(db.Model):
+    __tablename__ = 'notification_counters'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    unread = db.Column(db.Integer, default=0, nullable=False)
+    last_notification_id = db.Column(db.Integer, nullable=True)  # cheap change marker for pollers
 
 class Badge(db.Model):
     __tablename__ = 'badges'
@@ -222,7 +303,7 @@ class PublicFeedIndex(db.Model):
 class SyncLog(db.Model):
     __tablename__ = 'sync_logs'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
     client_uuid = db.Column(db.String(64), nullable=True, index=True)
     source = db.Column(db.String(64))
     source_id = db.Column(db.Integer, nullable=True)
@@ -232,6 +313,28 @@ class SyncLog(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     resolved = db.Column(db.Boolean, default=False, index=True)
 
+class GazetteerState(db.Model):
+    __tablename__ = 'gazetteer_state'
+    id = db.Column(db.Integer, primary_key=True)  # single row, id=1
+    generation = db.Column(db.Integer, default=0, nullable=False)  # bumped whenever locations are merged away
+
+class UploadSession(db.Model):
+    __tablename__ = 'upload_sessions'
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    kind = db.Column(db.String(16), nullable=False)  # 'image' or 'audio'
+    original_name = db.Column(db.String(256))
+    ext = db.Column(db.String(16), nullable=False)  # validated by allowed_file() at creation
+    content_type = db.Column(db.String(64))
+    size = db.Column(db.Integer, nullable=False)
+    received = db.Column(db.Integer, default=0, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=True)  # expected digest of the whole file, if the client sent one
+    path = db.Column(db.String(1024))  # partial file, then the final location once complete
+    status = db.Column(db.String(16), default='open', nullable=False, index=True)  # open -> complete -> attached
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
 class MoodAggregateDaily(db.Model):
     __tablename__ = 'mood_aggregates_daily'
     id = db.Column(db.Integer, primary_key=True)
@@ -241,6 +344,22 @@ class MoodAggregateDaily(db.Model):
     count = db.Column(db.Integer, default=0)
     __table_args__ = (db.UniqueConstraint('user_id', 'date', 'mood', name='uq_user_date_mood'),)
 
+class SyncLogArchive(db.Model):
+    __tablename__ = 'sync_logs_archive'
+    id = db.Column(db.Integer, primary_key=True)  # original sync_logs.id
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    created_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    record = db.Column(db.LargeBinary)  # gzipped JSON of the full row
+
+class NotificationArchive(db.Model):
+    __tablename__ = 'notifications_archive'
+    id = db.Column(db.Integer, primary_key=True)  # original notifications.id
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    created_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    record = db.Column(db.LargeBinary)
+
 # --- Login loader ---
 @login_manager.user_loader
 def load_user(user_id):
@@ -269,6 +388,490 @@ def save_file(fileobj, subfolder='misc'):
     fileobj.save(path)
     return name, path
 
+# --- Static assets: fingerprinting, precompression & response compression ---
+# `flask build-assets` copies every file under static/ (except uploads) to static/dist/ with a
+# content hash in its name, writes .gz/.br siblings, and records the mapping in manifest.json.
+# Templates keep calling url_for('static', filename='js/main.js'); the override below swaps in
+# the hashed name so those URLs can be cached forever.
+_asset_manifest = None
+
+def asset_manifest_path():
+    return os.path.join(app.static_folder, app.config['ASSET_DIST_DIR'], 'manifest.json')
+
+def load_asset_manifest(reload=False):
+    global _asset_manifest
+    if _asset_manifest is None or reload:
+        try:
+            with open(asset_manifest_path()) as fh:
+                _asset_manifest = json.load(fh)
+        except (OSError, ValueError):
+            _asset_manifest = {}
+    return _asset_manifest
+
+def asset_url_for(endpoint, **values):
+    if endpoint == 'static' and values.get('filename') in load_asset_manifest():
+        values['filename'] = load_asset_manifest()[values['filename']]
+    return url_for(endpoint, **values)
+
+app.jinja_env.globals['url_for'] = asset_url_for
+
+@app.context_processor
+def inject_asset_manifest():
+    return {'static_manifest': load_asset_manifest()}
+
+def accepted_encodings():
+    # preference order: brotli (if available) then gzip
+    encodings = []
+    if brotli is not None and request.accept_encodings['br']:
+        encodings.append('br')
+    if request.accept_encodings['gzip']:
+        encodings.append('gzip')
+    return encodings
+
+def compress_bytes(data, encoding, level=None):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if level is None else level)
+    return gzip.compress(data, compresslevel=9 if level is None else level, mtime=0)
+
+def serve_static(filename):
+    # hashed files are immutable and may have precompressed siblings
+    if filename not in set(load_asset_manifest().values()):
+        return app.send_static_file(filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding in accepted_encodings():
+        suffix = '.br' if encoding == 'br' else '.gz'
+        if os.path.exists(os.path.join(app.static_folder, filename + suffix)):
+            response = send_from_directory(app.static_folder, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            # send_file names the .gz/.br sibling here; the client should only see the asset itself
+            response.headers.pop('Content-Disposition', None)
+            break
+    else:
+        response = send_from_directory(app.static_folder, filename, mimetype=mimetype)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.vary.add('Accept-Encoding')
+    return response
+
+app.view_functions['static'] = serve_static
+
+@app.after_request
+def compress_response(response):
+    # negotiated compression for dynamic responses (HTML, JSON) above a size threshold
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in app.config['COMPRESS_MIMETYPES']):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    encodings = accepted_encodings()
+    if len(data) < app.config['COMPRESS_MIN_SIZE'] or not encodings:
+        return response
+    level = app.config['COMPRESS_LEVEL'] if encodings[0] == 'gzip' else 5
+    response.set_data(compress_bytes(data, encodings[0], level))
+    response.headers['Content-Encoding'] = encodings[0]
+    return response
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Fingerprint static files into static/dist and precompress them.
+
+    If static/css/tailwind.css exists (e.g. built with the tailwind CLI) pages use it
+    instead of the runtime CDN script.
+    """
+    static_root = app.static_folder
+    dist_root = os.path.join(static_root, app.config['ASSET_DIST_DIR'])
+    shutil.rmtree(dist_root, ignore_errors=True)
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(static_root):
+        if dirpath == static_root:
+            dirnames[:] = [d for d in dirnames if d not in app.config['ASSET_SKIP_DIRS']]
+        for name in sorted(filenames):
+            src = os.path.join(dirpath, name)
+            rel = os.path.relpath(src, static_root).replace(os.sep, '/')
+            with open(src, 'rb') as fh:
+                data = fh.read()
+            digest = hashlib.sha256(data).hexdigest()[:10]
+            stem, ext = os.path.splitext(rel)
+            hashed = f"{app.config['ASSET_DIST_DIR']}/{stem}.{digest}{ext}"
+            dest = os.path.join(static_root, hashed)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, 'wb') as fh:
+                fh.write(data)
+            manifest[rel] = hashed
+            sizes = [f"{len(data)}B"]
+            if ext.lstrip('.').lower() in app.config['ASSET_PRECOMPRESS_EXT']:
+                for encoding, suffix in (('gzip', '.gz'), ('br', '.br')):
+                    if encoding == 'br' and brotli is None:
+                        continue
+                    packed = compress_bytes(data, encoding)
+                    if len(packed) < len(data):
+                        with open(dest + suffix, 'wb') as fh:
+                            fh.write(packed)
+                        sizes.append(f"{suffix[1:]} {len(packed)}B")
+            click.echo(f"{rel} -> {hashed} ({', '.join(sizes)})")
+    with open(asset_manifest_path(), 'w') as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+    load_asset_manifest(reload=True)
+    if brotli is None:
+        click.echo('brotli not installed: skipped .br files')
+    click.echo(f"wrote {len(manifest)} assets to {asset_manifest_path()}")
+
+@app.cli.command('page-weight')
+@click.option('--path', 'paths', multiple=True, help='Page to measure (repeatable).')
+def page_weight(paths):
+    """Report transferred bytes per page and asset, uncompressed vs negotiated."""
+    paths = paths or ('/login', '/register', '/public_feed', '/api/public_feed?per_page=50')
+    accept = 'br, gzip' if brotli is not None else 'gzip'
+    client = app.test_client()
+    total_before = total_after = 0
+    originals = {hashed: rel for rel, hashed in load_asset_manifest().items()}
+    static_ref = re.compile(r'(?:src|href)="(' + re.escape(app.static_url_path) + r'/[^"?#]+)"')
+    assets = []
+    click.echo(f"{'resource':48} {'identity':>10} {'encoded':>10}")
+    for path in paths:
+        plain = client.get(path, headers={'Accept-Encoding': 'identity'})
+        packed = client.get(path, headers={'Accept-Encoding': accept})
+        before, after = len(plain.get_data()), len(packed.get_data())
+        total_before += before; total_after += after
+        click.echo(f"{path:48} {before:>10} {after:>10} [{packed.status_code} {packed.headers.get('Content-Encoding', '-')}]")
+        if plain.mimetype == 'text/html':
+            assets.extend(url for url in static_ref.findall(plain.get_data(as_text=True)) if url not in assets)
+    # only assets the measured pages actually reference; "before" is the unhashed, uncompressed file
+    for url in assets:
+        filename = url[len(app.static_url_path) + 1:]
+        source = originals.get(filename, filename)
+        if not os.path.exists(os.path.join(app.static_folder, source)):
+            continue
+        before = os.path.getsize(os.path.join(app.static_folder, source))
+        resp = client.get(url, headers={'Accept-Encoding': accept})
+        after = len(resp.get_data())
+        total_before += before; total_after += after
+        click.echo(f"{url:48} {before:>10} {after:>10} [{resp.headers.get('Cache-Control', '-')}]")
+    if 'css/tailwind.css' not in load_asset_manifest():
+        click.echo(f"note: pages still load {app.config['TAILWIND_CDN_URL']} at runtime (not measured)")
+    click.echo(f"{'total':48} {total_before:>10} {total_after:>10}")
+
+# --- Admission control: rate limiting & concurrency caps ---
+# Heavy handlers (uploads, sync batches) hold a write transaction and do disk I/O, so a burst can
+# starve every worker. Each request first takes a slot in its group's in-flight cap (503 when full),
+# then a token from a per user+endpoint bucket (429 when empty), so a request turned away for lack
+# of a slot doesn't use up a token. Both answer with Retry-After.
+class MemoryRateLimitBackend:
+    """Token buckets held in this process; fine for a single worker."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, cost=1):
+        # returns seconds to wait; 0 means the request was admitted
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (cost - tokens) / rate
+
+class SQLiteRateLimitBackend:
+    """Token buckets in a small SQLite file shared by every worker on the host."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, capacity, rate, cost=1):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0, now - updated) * rate)
+            wait = 0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+if app.config['RATE_LIMIT_BACKEND'] == 'sqlite':
+    rate_limiter = SQLiteRateLimitBackend(app.config['RATE_LIMIT_SQLITE_PATH'])
+else:
+    rate_limiter = MemoryRateLimitBackend()
+
+concurrency_slots = {group: threading.BoundedSemaphore(n) for group, n in app.config['CONCURRENCY_LIMITS'].items()}
+admission_metrics = Counter()
+_metrics_lock = threading.Lock()
+
+def record_admission(endpoint, outcome):
+    with _metrics_lock:
+        admission_metrics[(endpoint, outcome)] += 1
+
+def admission_rejected(status, retry_after, message):
+    retry_after = max(1, math.ceil(retry_after))
+    if request.path.startswith('/api/') or request.is_json:
+        response = jsonify({'error': message, 'retry_after': retry_after})
+    else:
+        response = render_template('error.html', error_message=message)
+    return response, status, {'Retry-After': str(retry_after)}
+
+def admission_control(group, methods=('POST',)):
+    """Rate-limit and cap concurrency of a view. Apply below @login_required."""
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if request.method not in methods:
+                return view(*args, **kwargs)
+            endpoint = request.endpoint
+            # take the slot first so a 503 doesn't spend the user's rate-limit tokens
+            slots = concurrency_slots.get(group)
+            if slots is not None and not slots.acquire(blocking=False):
+                record_admission(endpoint, 'overloaded')
+                return admission_rejected(503, app.config['CONCURRENCY_RETRY_AFTER'], 'Server is busy, please retry shortly.')
+            try:
+                limit = app.config['RATE_LIMITS'].get(endpoint)
+                if limit:
+                    capacity, rate = limit
+                    wait = rate_limiter.take(f"{current_user.id}:{endpoint}", capacity, rate)
+                    if wait:
+                        record_admission(endpoint, 'rate_limited')
+                        return admission_rejected(429, wait, 'Too many requests, please slow down.')
+                record_admission(endpoint, 'admitted')
+                return view(*args, **kwargs)
+            finally:
+                if slots is not None:
+                    slots.release()
+        return wrapped
+    return decorator
+
+# --- Location gazetteer ---
+# Posting from the same place every day used to add a Location row per post. Incoming points now
+# snap to the nearest known location within GAZETTEER_RADIUS_M. Known locations are held in a grid
+# of cells one radius wide, loaded from the DB a neighbourhood at a time and kept in a bounded LRU;
+# rows inserted by this process are added once their transaction commits. Duplicates created by
+# other workers (or before this existed) are merged by dedupe_locations(), which bumps a generation
+# counter in gazetteer_state so every worker drops its cache before the next lookup.
+EARTH_M_PER_DEG = 111320.0
+
+def distance_m(lat1, lon1, lat2, lon2):
+    # equirectangular approximation, plenty for radii of a few hundred metres
+    dx = (lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2)) * EARTH_M_PER_DEG
+    dy = (lat2 - lat1) * EARTH_M_PER_DEG
+    return math.hypot(dx, dy)
+
+class Gazetteer:
+    """Nearest-location lookup on a lat/lon grid; load_from_db=False gives a purely in-memory index."""
+
+    def __init__(self, radius_m, max_cells=None, load_from_db=True):
+        self.radius_m = radius_m
+        self.cell = radius_m / EARTH_M_PER_DEG
+        self.max_cells = max_cells
+        self.load_from_db = load_from_db
+        self._cells = OrderedDict()  # (row, col) -> {location_id: (lat, lon, name)}
+        self._lock = threading.Lock()
+        self.generation = None
+
+    def _key(self, lat, lon):
+        return math.floor(lat / self.cell), math.floor(lon / self.cell)
+
+    def _keys_around(self, lat, lon):
+        # a degree of longitude shrinks with latitude, so look further east/west
+        row, col = self._key(lat, lon)
+        span = math.ceil(1 / max(math.cos(math.radians(lat)), 0.01))
+        return [(r, c) for r in range(row - 1, row + 2) for c in range(col - span, col + span + 1)]
+
+    def _load(self, keys):
+        missing = [k for k in keys if k not in self._cells]
+        if not missing:
+            return
+        fetched = {k: {} for k in missing}
+        if self.load_from_db:
+            rows = db.session.execute(select(Location.id, Location.latitude, Location.longitude, Location.name).where(
+                Location.latitude >= min(k[0] for k in missing) * self.cell,
+                Location.latitude < (max(k[0] for k in missing) + 1) * self.cell,
+                Location.longitude >= min(k[1] for k in missing) * self.cell,
+                Location.longitude < (max(k[1] for k in missing) + 1) * self.cell)).all()
+            for loc_id, lat, lon, name in rows:
+                key = self._key(lat, lon)
+                if key in fetched:
+                    fetched[key][loc_id] = (lat, lon, name)
+        self._cells.update(fetched)
+        while self.max_cells and len(self._cells) > self.max_cells:
+            self._cells.popitem(last=False)
+
+    def nearest(self, lat, lon):
+        """Return (location_id, name, lat, lon) of the closest known location within the radius, or None."""
+        keys = self._keys_around(lat, lon)
+        with self._lock:
+            self._load(keys)
+            best, best_d = None, self.radius_m
+            for key in keys:
+                self._cells.move_to_end(key)
+                for loc_id, (llat, llon, name) in self._cells[key].items():
+                    d = distance_m(lat, lon, llat, llon)
+                    if d <= best_d:
+                        best, best_d = (loc_id, name, llat, llon), d
+            return best
+
+    def add(self, loc_id, lat, lon, name):
+        key = self._key(lat, lon)
+        with self._lock:
+            if key in self._cells:
+                self._cells[key][loc_id] = (lat, lon, name)
+            elif not self.load_from_db:
+                self._cells[key] = {loc_id: (lat, lon, name)}
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+
+    def sync_generation(self, generation):
+        # another worker merged (deleted) locations: everything cached may point at removed rows
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+def gazetteer_generation():
+    return db.session.execute(select(GazetteerState.generation).where(GazetteerState.id == 1)).scalar() or 0
+
+def bump_gazetteer_generation():
+    # caller commits, in the same transaction as the deletes
+    result = db.session.execute(update(GazetteerState).where(GazetteerState.id == 1)
+                                .values(generation=GazetteerState.generation + 1),
+                                execution_options={'synchronize_session': False})
+    if result.rowcount == 0:
+        db.session.add(GazetteerState(id=1, generation=1))
+
+def parse_coordinates(lat, lon):
+    """Return (lat, lon) as finite floats in range, or None."""
+    try:
+        latf, lonf = float(lat), float(lon)
+    except (TypeError, ValueError):
+        return None
+    if not (math.isfinite(latf) and math.isfinite(lonf) and -90 <= latf <= 90 and -180 <= lonf <= 180):
+        return None
+    return latf, lonf
+
+gazetteer = Gazetteer(app.config['GAZETTEER_RADIUS_M'], max_cells=app.config['GAZETTEER_CACHE_CELLS'])
+
+@event.listens_for(Session, 'after_commit')
+def _cache_committed_locations(session):
+    for loc in session.info.pop('gazetteer_pending', ()):
+        gazetteer.add(*loc)
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_rolled_back_locations(session):
+    session.info.pop('gazetteer_pending', None)
+
+def resolve_locations(points):
+    """Map point dicts (latitude, longitude, name) to Location ids, reusing nearby rows (caller commits)."""
+    ids = [None] * len(points)
+    new_points, name_fills = [], {}
+    gazetteer.sync_generation(gazetteer_generation())
+    batch_grid = Gazetteer(gazetteer.radius_m, load_from_db=False)  # points new in this call
+    points = [{**p, 'name': p.get('name') or None} for p in points]
+    for i, p in enumerate(points):
+        hit = gazetteer.nearest(p['latitude'], p['longitude'])
+        if hit:
+            ids[i] = hit[0]
+            if p.get('name') and not hit[1]:
+                name_fills.setdefault(hit[0], (p['name'], hit[2], hit[3]))
+            continue
+        local = batch_grid.nearest(p['latitude'], p['longitude'])
+        if local:
+            ids[i] = local[0]  # negative placeholder, resolved after the insert
+            if p.get('name') and not local[1]:
+                new_points[-local[0] - 1]['name'] = p['name']
+                batch_grid.add(local[0], local[2], local[3], p['name'])
+            continue
+        new_points.append(p)
+        ids[i] = -len(new_points)
+        batch_grid.add(ids[i], p['latitude'], p['longitude'], p.get('name'))
+    pending = db.session.info.setdefault('gazetteer_pending', [])
+    if new_points:
+        precision = f"{gazetteer.radius_m:g}m"
+        new_ids = db.session.execute(insert(Location).returning(Location.id, sort_by_parameter_order=True), [
+            {'name': p.get('name'), 'latitude': p['latitude'], 'longitude': p['longitude'], 'precision': precision,
+             'created_at': datetime.utcnow()} for p in new_points]).scalars().all()
+        ids = [new_ids[-i - 1] if i < 0 else i for i in ids]
+        pending.extend((loc_id, p['latitude'], p['longitude'], p.get('name')) for loc_id, p in zip(new_ids, new_points))
+    for loc_id, (name, lat, lon) in name_fills.items():
+        db.session.execute(update(Location).where(Location.id == loc_id, or_(Location.name.is_(None), Location.name == ''))
+                           .values(name=name),
+                           execution_options={'synchronize_session': False})
+        pending.append((loc_id, lat, lon, name))
+    return ids
+
+def resolve_location(lat, lon, name=None):
+    return resolve_locations([{'latitude': lat, 'longitude': lon, 'name': name}])[0]
+
+def dedupe_locations(radius_m=None, dry_run=False, chunk_size=500):
+    """Merge locations within radius_m of an older one, repointing every location_id; returns merges."""
+    radius_m = radius_m or gazetteer.radius_m
+    grid = Gazetteer(radius_m, load_from_db=False)
+    merges, names = {}, {}
+    rows = db.session.execute(select(Location.id, Location.latitude, Location.longitude, Location.name)
+                              .order_by(Location.id).execution_options(yield_per=1000))
+    for loc_id, lat, lon, name in rows:
+        hit = grid.nearest(lat, lon)
+        if hit is None:
+            grid.add(loc_id, lat, lon, name)
+            continue
+        merges[loc_id] = hit[0]
+        if name and not hit[1] and hit[0] not in names:
+            names[hit[0]] = name
+    db.session.commit()
+    if dry_run:
+        return len(merges)
+    pairs = list(merges.items())
+    for start in range(0, len(pairs), chunk_size):
+        chunk = dict(pairs[start:start + chunk_size])
+        try:
+            for model in (DiaryEntry, Memory, PublicFeedIndex):
+                db.session.execute(update(model).where(model.location_id.in_(list(chunk)))
+                                   .values(location_id=case(chunk, value=model.location_id)),
+                                   execution_options={'synchronize_session': False})
+            db.session.execute(delete(Location).where(Location.id.in_(list(chunk))))
+            bump_gazetteer_generation()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    for loc_id, name in names.items():
+        db.session.execute(update(Location).where(Location.id == loc_id, or_(Location.name.is_(None), Location.name == ''))
+                           .values(name=name),
+                           execution_options={'synchronize_session': False})
+    db.session.execute(update(Location).where(Location.precision.is_(None)).values(precision=f"{radius_m:g}m"),
+                       execution_options={'synchronize_session': False})
+    db.session.commit()
+    gazetteer.clear()
+    return len(merges)
+
+@app.cli.command('dedupe-locations')
+@click.option('--dry-run', is_flag=True)
+@click.option('--radius', type=float, default=None, help='Merge radius in metres (default GAZETTEER_RADIUS_M).')
+def dedupe_locations_command(dry_run, radius):
+    """Merge duplicate Location rows and repoint entries, memories and feed rows."""
+    before = db.session.query(db.func.count(Location.id)).scalar()
+    merged = dedupe_locations(radius_m=radius, dry_run=dry_run)
+    click.echo(f"{'would merge' if dry_run else 'merged'} {merged} of {before} locations")
+
 # --- Routes: auth & home ---
 @app.route('/')
 @login_required
@@ -330,6 +933,7 @@ def list_entries():
 
 @app.route('/entry/new', methods=['GET', 'POST'])
 @login_required
+@admission_control('upload')
 def create_entry():
     if request.method == 'POST':
         title = request.form.get('title') or 'Untitled'
@@ -351,15 +955,9 @@ def create_entry():
             chapter=chapter
         )
 
-        if lat and lon:
-            try:
-                latf = float(lat); lonf = float(lon)
-                loc = Location(name=request.form.get('location_name'), latitude=latf, longitude=lonf)
-                db.session.add(loc)
-                db.session.flush()  # set loc.id
-                entry.location = loc
-            except Exception:
-                pass
+        coords = parse_coordinates(lat, lon) if lat and lon else None
+        if coords:
+            entry.location_id = resolve_location(*coords, request.form.get('location_name'))
 
         db.session.add(entry)
         db.session.commit()
@@ -381,6 +979,11 @@ def create_entry():
                 filename, path = save_file(audio, subfolder='audio')
                 att = Attachment(uploader=current_user, filename=filename, original_name=audio.filename, path=path, content_type=audio.mimetype, diary_entry_id=entry.id)
                 db.session.add(att)
+        # attachments sent earlier through the resumable upload API
+        for kind in ('image', 'audio'):
+            if request.form.get(f'{kind}_upload_id'):
+                if attach_upload(request.form[f'{kind}_upload_id'], kind, diary_entry_id=entry.id) is None:
+                    flash(f'The {kind} upload could not be attached: it is unknown, unfinished or expired')
 
         db.session.commit()
         evaluate_badges_for_user(current_user.id)
@@ -439,6 +1042,7 @@ def list_memories():
 
 @app.route('/memory/new', methods=['GET', 'POST'])
 @login_required
+@admission_control('upload')
 def create_memory():
     if request.method == 'POST':
         title = request.form.get('title')
@@ -447,15 +1051,9 @@ def create_memory():
         lat = request.form.get('lat')
         lon = request.form.get('lon')
         memory = Memory(author=current_user, title=title, description=description, visibility=visibility)
-        if lat and lon:
-            try:
-                latf = float(lat); lonf = float(lon)
-                loc = Location(name=request.form.get('location_name'), latitude=latf, longitude=lonf)
-                db.session.add(loc)
-                db.session.flush()
-                memory.location = loc
-            except Exception:
-                pass
+        coords = parse_coordinates(lat, lon) if lat and lon else None
+        if coords:
+            memory.location_id = resolve_location(*coords, request.form.get('location_name'))
         db.session.add(memory)
         db.session.commit()
         # attachments
@@ -465,6 +1063,10 @@ def create_memory():
                 filename, path = save_file(image, subfolder='images')
                 att = Attachment(uploader=current_user, filename=filename, original_name=image.filename, path=path, content_type=image.mimetype, memory_id=memory.id)
                 db.session.add(att)
+        for kind in ('image', 'audio'):
+            if request.form.get(f'{kind}_upload_id'):
+                if attach_upload(request.form[f'{kind}_upload_id'], kind, memory_id=memory.id) is None:
+                    flash(f'The {kind} upload could not be attached: it is unknown, unfinished or expired')
         db.session.commit()
         if visibility in (Visibility.PUBLIC.value, Visibility.ANONYMOUS.value):
             push_public_feed(source_type='memory', source=memory, is_anonymous=(visibility == Visibility.ANONYMOUS.value))
@@ -472,6 +1074,173 @@ def create_memory():
         return redirect(url_for('list_memories'))
     return render_template('add_memory.html')
 
+# --- Resumable uploads ---
+# Large recordings from phones are sent as a session: POST /api/uploads to open it, PUT chunks
+# at the current offset (a retried chunk at the wrong offset gets 409 and the real offset), GET
+# to ask where to resume, then POST .../finalize to verify and move the file into UPLOAD_FOLDER.
+# The finished upload is referenced as image_upload_id / audio_upload_id when the entry or memory
+# is created. Unattached sessions are removed by job_cleanup_uploads once they expire.
+def upload_session_or_404(upload_id):
+    up = UploadSession.query.filter_by(id=upload_id, user_id=current_user.id).first()
+    if up is None:
+        abort(404)
+    return up
+
+def upload_state(up):
+    return {'upload_id': up.id, 'offset': up.received, 'size': up.size, 'status': up.status,
+            'expires_at': up.expires_at.isoformat()}
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def api_upload_create():
+    data = request.json or {}
+    kind = data.get('kind')
+    filename = data.get('filename') or ''
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size is required'}), 400
+    if kind not in ('image', 'audio') or not allowed_file(filename, kind):
+        return jsonify({'error': 'unsupported file type'}), 400
+    if size <= 0 or size > app.config['UPLOAD_MAX_SIZE']:
+        return jsonify({'error': 'file too large'}), 413
+    # the extension comes from the validated raw name: secure_filename() drops non-ASCII stems
+    # entirely ('录音.webm' -> 'webm'), so it can't be re-derived from a sanitized name later
+    up = UploadSession(user_id=current_user.id, kind=kind, original_name=filename[:256],
+                       ext=filename.rsplit('.', 1)[1].lower(), content_type=data.get('content_type'), size=size, sha256=(data.get('sha256') or '').lower() or None,
+                       expires_at=datetime.utcnow() + app.config['UPLOAD_SESSION_TTL'])
+    db.session.add(up)
+    db.session.flush()
+    os.makedirs(app.config['UPLOAD_TMP_FOLDER'], exist_ok=True)
+    up.path = os.path.join(app.config['UPLOAD_TMP_FOLDER'], up.id)
+    open(up.path, 'wb').close()
+    db.session.commit()
+    return jsonify({**upload_state(up), 'chunk_size': app.config['UPLOAD_CHUNK_SIZE']}), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def api_upload_status(upload_id):
+    return jsonify(upload_state(upload_session_or_404(upload_id)))
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+@admission_control('upload', methods=('PUT',))
+def api_upload_chunk(upload_id):
+    """Append the request body at ?offset=N (or the Upload-Offset header)."""
+    up = upload_session_or_404(upload_id)
+    if up.status != 'open':
+        return jsonify({**upload_state(up), 'error': 'upload is already finalized'}), 409
+    offset = request.args.get('offset', request.headers.get('Upload-Offset'))
+    if offset is None or not str(offset).isdigit() or int(offset) != up.received:
+        return jsonify({**upload_state(up), 'error': 'offset mismatch'}), 409
+    length = request.content_length
+    if length is None or length > app.config['UPLOAD_MAX_CHUNK'] or up.received + length > up.size:
+        return jsonify({**upload_state(up), 'error': 'chunk too large'}), 413
+    # receive into a private file first so a slow or stalled client never holds the session lock
+    chunk_path = f"{up.path}.{uuid.uuid4().hex}.chunk"
+    try:
+        digest = hashlib.sha256()
+        written = 0
+        with open(chunk_path, 'wb') as chunk:
+            for block in iter(lambda: request.stream.read(64 * 1024), b''):
+                digest.update(block)
+                chunk.write(block)
+                written += len(block)
+        expected = request.headers.get('X-Chunk-SHA256')
+        if written != length or (expected and expected.lower() != digest.hexdigest()):
+            return jsonify({**upload_state(up), 'error': 'chunk incomplete or checksum mismatch'}), 400
+        with open(up.path, 'r+b') as fh:
+            # one appender per session (across workers): re-check the offset under the lock, then
+            # append and record it before anyone else may touch the file
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            db.session.expire(up)
+            if up.status != 'open' or int(offset) != up.received or up.received + written > up.size:
+                db.session.commit()
+                return jsonify({**upload_state(up), 'error': 'offset mismatch'}), 409
+            # drop bytes a crashed attempt may have left past the recorded offset
+            fh.truncate(up.received)
+            fh.seek(up.received)
+            with open(chunk_path, 'rb') as chunk:
+                shutil.copyfileobj(chunk, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+            up.received += written
+            up.expires_at = datetime.utcnow() + app.config['UPLOAD_SESSION_TTL']  # stale means idle, not old
+            db.session.commit()
+    finally:
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+    return jsonify(upload_state(up))
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def api_upload_finalize(upload_id):
+    up = upload_session_or_404(upload_id)
+    if up.status != 'open':
+        return jsonify(upload_state(up))
+    if up.received != up.size:
+        return jsonify({**upload_state(up), 'error': 'upload incomplete'}), 409
+    if up.sha256 and file_sha256(up.path) != up.sha256:
+        return jsonify({**upload_state(up), 'error': 'checksum mismatch'}), 422
+    folder = os.path.join(app.config['UPLOAD_FOLDER'], 'images' if up.kind == 'image' else 'audio')
+    os.makedirs(folder, exist_ok=True)
+    final_path = os.path.join(folder, f"{uuid.uuid4().hex}.{up.ext}")
+    shutil.move(up.path, final_path)
+    up.path = final_path
+    up.status = 'complete'
+    up.expires_at = datetime.utcnow() + app.config['UPLOAD_SESSION_TTL']
+    db.session.commit()
+    return jsonify(upload_state(up))
+
+def attach_upload(upload_id, kind, **owner):
+    """Turn a finalized upload of the current user into an Attachment (caller commits); None if unusable."""
+    now = datetime.utcnow()
+    up = UploadSession.query.filter(UploadSession.id == upload_id, UploadSession.user_id == current_user.id,
+                                    UploadSession.kind == kind, UploadSession.status == 'complete',
+                                    UploadSession.expires_at > now).first()
+    if up is None:
+        return None
+    # claim it conditionally: a concurrent attach or the cleanup job may have taken it since the read
+    claimed = db.session.execute(update(UploadSession)
+                                 .where(UploadSession.id == up.id, UploadSession.status == 'complete')
+                                 .values(status='attached'),
+                                 execution_options={'synchronize_session': False})
+    if claimed.rowcount != 1:
+        return None
+    att = Attachment(uploader=current_user, filename=os.path.basename(up.path), original_name=up.original_name,
+                     path=up.path, content_type=up.content_type, size=up.size, **owner)
+    db.session.add(att)
+    return att
+
+def cleanup_stale_uploads(now=None):
+    now = now or datetime.utcnow()
+    stale = db.session.execute(select(UploadSession.id, UploadSession.path)
+                               .where(UploadSession.expires_at < now, UploadSession.status != 'attached')).all()
+    removed = 0
+    for upload_id, path in stale:
+        # claim the row first: if it was attached (or resumed) since the read, its file is in use
+        claimed = db.session.execute(delete(UploadSession)
+                                     .where(UploadSession.id == upload_id, UploadSession.status != 'attached',
+                                            UploadSession.expires_at < now),
+                                     execution_options={'synchronize_session': False})
+        db.session.commit()
+        if claimed.rowcount == 1:
+            removed += 1
+            if path and os.path.exists(path):
+                os.remove(path)
+    # attached sessions have done their job; the Attachment row keeps the file
+    UploadSession.query.filter(UploadSession.expires_at < now, UploadSession.status == 'attached') \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
 # --- Public feed ---
 @app.route('/public_feed')
 def public_feed():
@@ -520,10 +1289,12 @@ def api_public_feed():
     return jsonify({'items': results, 'page': page, 'pages': items.pages})
 
 # --- PublicFeed helper ---
+def feed_snippet(content):
+    return content[:497] + '...' if len(content) > 500 else content
+
 def push_public_feed(source_type, source, is_anonymous=False):
     # create or update PublicFeedIndex row
-    content = getattr(source, 'content', '')
-    snippet = content[:497] + '...' if len(content) > 500 else content
+    snippet = feed_snippet(getattr(source, 'content', ''))
     title = getattr(source, 'title', '')
     mood = getattr(source, 'mood', None)
     # delete old
@@ -543,6 +1314,233 @@ def push_public_feed(source_type, source, is_anonymous=False):
     db.session.add(pf)
     db.session.commit()
 
+# --- Batch writes: entries & memories ---
+# Importers and offline clients send hundreds of items at once. Everything is validated first
+# (invalid items are reported, not fatal), then locations, rows, attachments and feed rows go in
+# with bulk INSERTs in a single transaction; badges are evaluated once for the whole batch.
+def parse_iso_datetime(value, field, errors):
+    # stored naive in UTC like every datetime.utcnow() column
+    if value in (None, ''):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        errors.append(f'{field} must be an ISO datetime')
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def optional_str(item, field, max_length, errors):
+    value = item.get(field)
+    if value is not None and (not isinstance(value, str) or len(value) > max_length):
+        errors.append(f'{field} must be a string of at most {max_length} characters')
+        return None
+    return value
+
+def parse_batch_item(kind, item, uploads, used_uploads):
+    """Return (row values, location dict or None, upload sessions, errors) for one batch item."""
+    if not isinstance(item, dict):
+        return None, None, [], ['item must be an object']
+    errors = []
+    visibility = item.get('visibility') or Visibility.PRIVATE.value
+    if not isinstance(visibility, str) or visibility not in {v.value for v in Visibility}:
+        errors.append('invalid visibility')
+    title = optional_str(item, 'title', 200, errors)
+    if kind == 'entry':
+        content = item.get('content') or ''
+        if not isinstance(content, str):
+            errors.append('content must be a string')
+        values = {
+            'title': title or 'Untitled',
+            'content': content,
+            'mood': optional_str(item, 'mood', 30, errors),
+            'chapter': optional_str(item, 'chapter', 128, errors),
+            'visibility': visibility,
+            'client_uuid': optional_str(item, 'client_uuid', 64, errors),
+            'client_modified_at': parse_iso_datetime(item.get('client_modified_at'), 'client_modified_at', errors),
+        }
+    else:
+        description = item.get('description')
+        if description is not None and not isinstance(description, str):
+            errors.append('description must be a string')
+        values = {'title': title, 'description': description, 'visibility': visibility}
+    values['created_at'] = parse_iso_datetime(item.get('created_at'), 'created_at', errors) or datetime.utcnow()
+    location = None
+    lat, lon = item.get('lat'), item.get('lon')
+    location_name = optional_str(item, 'location_name', 256, errors)
+    if lat is not None or lon is not None:
+        coords = parse_coordinates(lat, lon)
+        if coords:
+            location = {'name': location_name, 'latitude': coords[0], 'longitude': coords[1]}
+        else:
+            errors.append('lat/lon must be valid coordinates')
+    attach = []
+    for file_type in ('image', 'audio'):
+        upload_id = optional_str(item, f'{file_type}_upload_id', 32, errors)
+        if not upload_id:
+            continue
+        up = uploads.get(upload_id)
+        if up is None or up.kind != file_type or upload_id in used_uploads:
+            errors.append(f'{file_type}_upload_id is not a finalized, unused upload')
+        else:
+            attach.append(up)
+    if not errors:
+        used_uploads.update(up.id for up in attach)
+    return values, location, attach, errors
+
+def batch_create(kind):
+    model, source_type = (DiaryEntry, 'entry') if kind == 'entry' else (Memory, 'memory')
+    payload = request.get_json(silent=True)
+    items = payload.get('items') if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items must be a non-empty list'}), 400
+    if len(items) > app.config['BATCH_MAX_ITEMS']:
+        return jsonify({'error': f"at most {app.config['BATCH_MAX_ITEMS']} items per batch"}), 413
+    user_id = current_user.id
+
+    # preload everything validation needs with one query each
+    # only well-typed values go into the lookups; parse_batch_item reports the rest per item
+    upload_ids = {i.get(f'{t}_upload_id') for i in items if isinstance(i, dict) for t in ('image', 'audio')
+                  if isinstance(i.get(f'{t}_upload_id'), str)} - {''}
+    uploads = {up.id: up for up in UploadSession.query.filter(
+        UploadSession.id.in_(upload_ids), UploadSession.user_id == user_id, UploadSession.status == 'complete',
+        UploadSession.expires_at > datetime.utcnow())} if upload_ids else {}
+    existing = {}
+    if kind == 'entry':
+        uuids = {i.get('client_uuid') for i in items
+                 if isinstance(i, dict) and isinstance(i.get('client_uuid'), str)} - {''}
+        if uuids:
+            existing = dict(db.session.execute(select(DiaryEntry.client_uuid, DiaryEntry.id).where(
+                DiaryEntry.user_id == user_id, DiaryEntry.client_uuid.in_(uuids))).all())
+
+    results = [None] * len(items)
+    valid = []  # (index, values, location, uploads)
+    used_uploads, seen_uuids = set(), set()
+    for index, item in enumerate(items):
+        client_uuid = item.get('client_uuid') if kind == 'entry' and isinstance(item, dict) else None
+        if not isinstance(client_uuid, str):
+            client_uuid = None  # non-strings are rejected by parse_batch_item
+        if client_uuid and client_uuid in existing:
+            # replayed by an offline client: report the row we already have
+            results[index] = {'index': index, 'status': 'exists', 'id': existing[client_uuid]}
+            continue
+        if client_uuid and client_uuid in seen_uuids:
+            results[index] = {'index': index, 'status': 'error', 'errors': ['duplicate client_uuid in batch']}
+            continue
+        values, location, attach, errors = parse_batch_item(kind, item, uploads, used_uploads)
+        if errors:
+            results[index] = {'index': index, 'status': 'error', 'errors': errors}
+            continue
+        seen_uuids.add(client_uuid)
+        valid.append((index, values, location, attach))
+
+    if used_uploads:
+        # the uploads were read before this transaction: claim them conditionally, and fail the items
+        # whose upload a concurrent batch or form post attached in the meantime
+        claimed = set(db.session.execute(
+            update(UploadSession).where(UploadSession.id.in_(used_uploads), UploadSession.status == 'complete')
+            .values(status='attached').returning(UploadSession.id),
+            execution_options={'synchronize_session': False}).scalars())
+        if claimed != used_uploads:
+            kept, released = [], set()
+            for entry in valid:
+                attach_ids = {up.id for up in entry[3]}
+                if attach_ids <= claimed:
+                    kept.append(entry)
+                    continue
+                released |= attach_ids & claimed
+                results[entry[0]] = {'index': entry[0], 'status': 'error',
+                                     'errors': ['upload was attached elsewhere while this batch ran']}
+            if released:
+                db.session.execute(update(UploadSession).where(UploadSession.id.in_(released)).values(status='complete'),
+                                   execution_options={'synchronize_session': False})
+            valid = kept
+        if not valid:
+            db.session.commit()  # otherwise the claims commit together with the inserted rows below
+
+    if valid:
+        try:
+            points = [location for _, _, location, _ in valid if location]
+            location_ids = iter(resolve_locations(points))
+            rows = []
+            for _, values, location, _ in valid:
+                rows.append({**values, 'user_id': user_id, 'location_id': next(location_ids) if location else None})
+            ids = db.session.execute(
+                insert(model).returning(model.id, sort_by_parameter_order=True), rows).scalars().all()
+
+            attachments = [{
+                'uploader_id': user_id, 'filename': os.path.basename(up.path), 'original_name': up.original_name,
+                'path': up.path, 'content_type': up.content_type, 'size': up.size, 'created_at': datetime.utcnow(),
+                'diary_entry_id': row_id if kind == 'entry' else None, 'memory_id': row_id if kind == 'memory' else None,
+            } for row_id, (_, _, _, attach) in zip(ids, valid) for up in attach]
+            if attachments:
+                db.session.execute(insert(Attachment), attachments)
+
+            feed_rows = []
+            for row_id, row in zip(ids, rows):
+                if row['visibility'] == Visibility.PRIVATE.value:
+                    continue
+                anonymous = row['visibility'] == Visibility.ANONYMOUS.value
+                feed_rows.append({
+                    'source_type': source_type, 'source_id': row_id, 'author_id': None if anonymous else user_id,
+                    'visibility': row['visibility'], 'is_anonymous': anonymous, 'title': row['title'],
+                    'snippet': feed_snippet(row.get('content', '')), 'mood': row.get('mood'),
+                    'location_id': row['location_id'], 'created_at': row['created_at'],
+                })
+            if feed_rows:
+                db.session.execute(insert(PublicFeedIndex), feed_rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for row_id, (index, _, _, _) in zip(ids, valid):
+            results[index] = {'index': index, 'status': 'created', 'id': row_id}
+        evaluate_badges_for_user(user_id)
+
+    return jsonify({'results': results, 'created': len(valid)})
+
+@app.route('/api/entries:batch', methods=['POST'])
+@login_required
+@admission_control('sync')
+def api_entries_batch():
+    return batch_create('entry')
+
+@app.route('/api/memories:batch', methods=['POST'])
+@login_required
+@admission_control('sync')
+def api_memories_batch():
+    return batch_create('memory')
+
+@app.cli.command('bench-batch-write')
+@click.option('--items', default=200, help='Entries to create through each path.')
+def bench_batch_write(items):
+    """Compare N single-item create_entry POSTs with one /api/entries:batch call. Use a scratch DATABASE_URL."""
+    db.create_all()
+    limits = app.config['RATE_LIMITS']
+    app.config['RATE_LIMITS'] = {}
+    username = f'bench-{uuid.uuid4().hex[:8]}'
+    user = User(username=username, email=f'{username}@bench.invalid')
+    user.set_password('bench')
+    db.session.add(user)
+    db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'bench'})
+    payload = [{'title': f'entry {i}', 'content': 'imported ' * 40, 'mood': 'calm', 'lat': 12.97 + i * 1e-3,
+                'lon': 77.59, 'visibility': 'public' if i % 4 == 0 else 'private'} for i in range(items)]
+    try:
+        started = time.perf_counter()
+        for item in payload:
+            client.post('/entry/new', data=item)
+        single = time.perf_counter() - started
+        started = time.perf_counter()
+        resp = client.post('/api/entries:batch', json={'items': payload})
+        batch = time.perf_counter() - started
+    finally:
+        app.config['RATE_LIMITS'] = limits
+    click.echo(f'single-item: {items} entries in {single:.2f}s ({items / single:.0f}/s)')
+    click.echo(f'batch:       {resp.json["created"]} entries in {batch:.2f}s ({items / batch:.0f}/s), {single / batch:.1f}x faster')
+
 # --- Map: memories and public posts ---
 @app.route('/api/memories/map')
 def api_memories_map():
@@ -585,7 +1583,11 @@ def create_capsule():
                 flash('Invalid date format. Use ISO format e.g. 2025-10-31T12:00')
                 return redirect(url_for('create_capsule'))
 
-        cap = Capsule(created_by=current_user, title=title, note=note, unlock_at=unlock_at)
+        reveal_policy = request.form.get('reveal_policy', Visibility.PRIVATE.value)
+        if reveal_policy not in {v.value for v in Visibility}:
+            reveal_policy = Visibility.PRIVATE.value
+
+        cap = Capsule(created_by=current_user, title=title, note=note, unlock_at=unlock_at, reveal_policy=reveal_policy)
         db.session.add(cap)
         db.session.commit()
         flash('Capsule created')
@@ -616,6 +1618,7 @@ def create_reminder():
 # --- Sync endpoint (simple stub) ---
 @app.route('/api/sync', methods=['POST'])
 @login_required
+@admission_control('sync')
 def api_sync():
     payload = request.json
     # expected: client_uuid, changes: [{change_id, source, data, client_modified_at}]
@@ -642,6 +1645,232 @@ def api_insights_moods():
     rows = db.session.query(DiaryEntry.mood, db.func.count(DiaryEntry.id)).filter(DiaryEntry.user_id == current_user.id, DiaryEntry.created_at >= since).group_by(DiaryEntry.mood).all()
     return jsonify({'moods': [{ 'mood': r[0], 'count': r[1] } for r in rows]})
 
+@app.route('/api/metrics/admission')
+@login_required
+def api_admission_metrics():
+    # process-wide counters: operators only
+    if current_user.username not in app.config['ADMIN_USERNAMES']:
+        abort(403)
+    with _metrics_lock:
+        counts = [{'endpoint': ep, 'outcome': outcome, 'count': n} for (ep, outcome), n in sorted(admission_metrics.items())]
+    return jsonify({'counters': counts, 'backend': app.config['RATE_LIMIT_BACKEND'], 'concurrency_limits': app.config['CONCURRENCY_LIMITS']})
+
+# --- Notifications: unread counters & push delivery ---
+# Unread counts live in notification_counters and are adjusted in the same transaction as the
+# insert/read, so clients never COUNT(*). Streams wait on the in-process broker (or poll the
+# counter row's last_notification_id when NOTIFY_BACKEND='poll') and receive pending rows in
+# batches, which are then stamped delivered_at with one UPDATE.
+class NotificationBroker:
+    """In-process pub/sub that wakes a user's waiting streams after a notification is committed."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+
+    def subscribe(self, user_id):
+        waiter = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(user_id, set()).add(waiter)
+        return waiter
+
+    def unsubscribe(self, user_id, waiter):
+        with self._lock:
+            waiters = self._waiters.get(user_id)
+            if waiters:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[user_id]
+
+    def publish(self, user_ids):
+        with self._lock:
+            waiters = [w for uid in user_ids for w in self._waiters.get(uid, ())]
+        for waiter in waiters:
+            waiter.set()
+
+notification_broker = NotificationBroker()
+
+@event.listens_for(Session, 'after_commit')
+def _publish_committed_notifications(session):
+    user_ids = session.info.pop('notify_user_ids', None)
+    if user_ids:
+        notification_broker.publish(user_ids)
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_rolled_back_notifications(session):
+    session.info.pop('notify_user_ids', None)
+
+def bump_unread(user_id, delta, last_notification_id=None):
+    # caller commits; a missing counter row is seeded from the table (which already reflects this change)
+    values = {'unread': NotificationCounter.unread + delta}
+    if last_notification_id is not None:
+        values['last_notification_id'] = last_notification_id
+    result = db.session.execute(
+        update(NotificationCounter).where(NotificationCounter.user_id == user_id).values(**values),
+        execution_options={'synchronize_session': False})
+    if result.rowcount == 0:
+        unread = Notification.query.filter_by(user_id=user_id, is_read=False).count()
+        last_id = db.session.query(db.func.max(Notification.id)).filter(Notification.user_id == user_id).scalar()
+        db.session.add(NotificationCounter(user_id=user_id, unread=unread, last_notification_id=last_id))
+
+def notify(user_id, title, body, data=None):
+    """Add a notification and bump the user's unread counter; streams wake once the caller commits."""
+    n = Notification(user_id=user_id, title=title, body=body, data=json.dumps(data) if data is not None else None)
+    db.session.add(n)
+    db.session.flush()
+    bump_unread(user_id, 1, last_notification_id=n.id)
+    db.session.info.setdefault('notify_user_ids', set()).add(user_id)
+    return n
+
+def notify_many(items):
+    """Bulk variant of notify() for jobs: one INSERT, one counter UPDATE per distinct user."""
+    if not items:
+        return
+    now = datetime.utcnow()
+    db.session.execute(insert(Notification), [{
+        'user_id': i['user_id'],
+        'title': i['title'],
+        'body': i['body'],
+        'data': json.dumps(i['data']) if i.get('data') is not None else None,
+        'is_read': False,
+        'created_at': now,
+    } for i in items])
+    per_user = Counter(i['user_id'] for i in items)
+    last_ids = dict(db.session.execute(
+        select(Notification.user_id, db.func.max(Notification.id))
+        .where(Notification.user_id.in_(list(per_user))).group_by(Notification.user_id)).all())
+    for user_id, n in per_user.items():
+        bump_unread(user_id, n, last_notification_id=last_ids.get(user_id))
+    db.session.info.setdefault('notify_user_ids', set()).update(per_user)
+
+def unread_count(user_id):
+    counter = db.session.get(NotificationCounter, user_id)
+    if counter is None:
+        bump_unread(user_id, 0)
+        db.session.commit()
+        counter = db.session.get(NotificationCounter, user_id)
+    return counter.unread
+
+def serialize_notification(n):
+    return {
+        'id': n.id,
+        'title': n.title,
+        'body': n.body,
+        'data': json.loads(n.data) if n.data else None,
+        'is_read': n.is_read,
+        'created_at': n.created_at.isoformat(),
+    }
+
+def take_pending_notifications(user_id, limit=None):
+    """Return undelivered notifications (oldest first) and mark them delivered in one UPDATE."""
+    rows = Notification.query.filter_by(user_id=user_id, delivered_at=None) \
+        .order_by(Notification.id).limit(limit or app.config['NOTIFY_BATCH_SIZE']).all()
+    items = [serialize_notification(n) for n in rows]
+    if rows:
+        db.session.execute(
+            update(Notification).where(Notification.id.in_([n.id for n in rows])).values(delivered_at=datetime.utcnow()),
+            execution_options={'synchronize_session': False})
+        db.session.commit()
+    return items
+
+def wait_for_notifications(user_id, waiter, timeout):
+    # memory: sleep until the broker fires; poll: watch the counter row's change marker
+    if app.config['NOTIFY_BACKEND'] != 'poll':
+        waiter.wait(timeout)
+        return
+    marker = select(NotificationCounter.last_notification_id).where(NotificationCounter.user_id == user_id)
+    seen = db.session.execute(marker).scalar()
+    db.session.commit()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(min(app.config['NOTIFY_POLL_INTERVAL'], max(0, deadline - time.monotonic())))
+        current = db.session.execute(marker).scalar()
+        db.session.commit()
+        if current != seen:
+            return
+
+@app.route('/api/notifications')
+@login_required
+def api_notifications():
+    page = int(request.args.get('page', 1))
+    per_page = int(request.args.get('per_page', 20))
+    query = Notification.query.filter_by(user_id=current_user.id).order_by(Notification.id.desc())
+    if request.args.get('unread') == '1':
+        query = query.filter_by(is_read=False)
+    items = query.paginate(page=page, per_page=per_page, error_out=False)
+    return jsonify({'items': [serialize_notification(n) for n in items.items], 'page': page, 'pages': items.pages,
+                    'unread': unread_count(current_user.id)})
+
+@app.route('/api/notifications/unread_count')
+@login_required
+def api_notifications_unread_count():
+    return jsonify({'unread': unread_count(current_user.id)})
+
+@app.route('/api/notifications/read', methods=['POST'])
+@login_required
+def api_notifications_read():
+    # body: {"ids": [...]} or {"all": true}
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'body must be an object'}), 400
+    stmt = update(Notification).where(Notification.user_id == current_user.id, Notification.is_read == False)
+    if not data.get('all'):
+        ids = data.get('ids', [])
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return jsonify({'error': 'ids must be a list of integers'}), 400
+        stmt = stmt.where(Notification.id.in_(ids))
+    now = datetime.utcnow()
+    result = db.session.execute(
+        stmt.values(is_read=True, delivered_at=db.func.coalesce(Notification.delivered_at, now)),
+        execution_options={'synchronize_session': False})
+    if result.rowcount:
+        bump_unread(current_user.id, -result.rowcount)
+    db.session.commit()
+    return jsonify({'updated': result.rowcount, 'unread': unread_count(current_user.id)})
+
+@app.route('/api/notifications/poll')
+@login_required
+def api_notifications_poll():
+    """Long-poll: returns as soon as something is pending, or empty after ?timeout seconds."""
+    user_id = current_user.id
+    timeout = min(float(request.args.get('timeout', 25)), 60)
+    waiter = notification_broker.subscribe(user_id)
+    try:
+        items = take_pending_notifications(user_id)
+        if not items:
+            wait_for_notifications(user_id, waiter, timeout)
+            items = take_pending_notifications(user_id)
+    finally:
+        notification_broker.unsubscribe(user_id, waiter)
+    return jsonify({'items': items, 'unread': unread_count(user_id)})
+
+@app.route('/api/notifications/stream')
+@login_required
+def api_notifications_stream():
+    """Server-Sent Events stream of notification batches plus the current unread count."""
+    user_id = current_user.id
+
+    def generate():
+        waiter = notification_broker.subscribe(user_id)
+        deadline = time.monotonic() + app.config['NOTIFY_STREAM_MAX_SECONDS']
+        try:
+            yield f"retry: {app.config['NOTIFY_POLL_INTERVAL'] * 1000}\n\n"
+            while time.monotonic() < deadline:
+                waiter.clear()
+                items = take_pending_notifications(user_id)
+                if items:
+                    payload = json.dumps({'items': items, 'unread': unread_count(user_id)})
+                    yield f"id: {items[-1]['id']}\nevent: notifications\ndata: {payload}\n\n"
+                    continue
+                yield ': keep-alive\n\n'
+                wait_for_notifications(user_id, waiter, min(app.config['NOTIFY_HEARTBEAT'], max(0, deadline - time.monotonic())))
+        finally:
+            notification_broker.unsubscribe(user_id, waiter)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # --- Badge evaluation (simple rules) ---
 def evaluate_badges_for_user(user_id):
     # examples: first_entry, wrote_10, uploaded_5_memories
@@ -672,27 +1901,292 @@ def uploaded_file(filename):
     # filename like images/<file>
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
+# --- Retention: archive & compact SyncLog / Notification ---
+# Rows past their table's policy are copied to a compact archive (one gzipped JSON blob per row in
+# *_archive, or NDJSON.gz files) and deleted in small batches, each its own short transaction, so
+# the write lock is never held for long. Space is then returned with an incremental VACUUM.
+RETENTION_MODELS = {
+    # table -> (model, archive model)
+    'sync_logs': (SyncLog, SyncLogArchive),
+    'notifications': (Notification, NotificationArchive),
+}
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def retention_candidates(table, now):
+    # union of: done rows past max_age, any row past hard_max_age, done rows beyond the per-user cap
+    model, _ = RETENTION_MODELS[table]
+    policy = app.config['RETENTION_POLICIES'].get(table, {})
+    done = getattr(model, policy['done_column']) == True if policy.get('done_column') else true()
+    queries = []
+    if policy.get('max_age_days') is not None:
+        queries.append(select(model.id).where(done, model.created_at < now - timedelta(days=policy['max_age_days'])))
+    if policy.get('hard_max_age_days') is not None:
+        queries.append(select(model.id).where(model.created_at < now - timedelta(days=policy['hard_max_age_days'])))
+    if policy.get('per_user_cap'):
+        rank = db.func.row_number().over(partition_by=model.user_id, order_by=(model.created_at.desc(), model.id.desc()))
+        ranked = select(model.id, rank.label('rank')).where(done).subquery()
+        queries.append(select(ranked.c.id).where(ranked.c.rank > policy['per_user_cap']))
+    if not queries:
+        return None
+    return (queries[0] if len(queries) == 1 else queries[0].union(*queries[1:])).subquery()
+
+def table_size_bytes(table):
+    # table + its indexes; None when the backend can't tell us
+    engine = db.engine
+    try:
+        with engine.connect() as conn:
+            if engine.dialect.name == 'sqlite':
+                return conn.execute(text(
+                    'SELECT SUM(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = :t)'
+                ), {'t': table}).scalar()
+            if engine.dialect.name == 'postgresql':
+                return conn.execute(text('SELECT pg_total_relation_size(:t)'), {'t': table}).scalar()
+    except Exception:
+        return None
+    return None
+
+def retention_report(now=None):
+    now = now or datetime.utcnow()
+    report = []
+    for table, (model, _) in RETENTION_MODELS.items():
+        candidates = retention_candidates(table, now)
+        eligible = 0 if candidates is None else db.session.execute(select(db.func.count()).select_from(candidates)).scalar()
+        total = db.session.query(db.func.count(model.id)).scalar()
+        size = table_size_bytes(table)
+        reclaimable = int(size * eligible / total) if size and total else None
+        report.append({'table': table, 'rows': total, 'eligible': eligible, 'size_bytes': size, 'reclaimable_bytes': reclaimable})
+    return report
+
+def write_ndjson_archive(table, records, now):
+    folder = app.config['RETENTION_ARCHIVE_DIR']
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{table}-{now:%Y-%m-%d}.ndjson.gz")
+    # gzip members can be appended; readers see one continuous stream
+    with gzip.open(path, 'at', encoding='utf-8') as fh:
+        for rec in records:
+            fh.write(json.dumps(rec, default=_json_default) + '\n')
+    return path
+
+def apply_retention(table, archive=None, batch_size=None, now=None):
+    """Archive and delete rows past policy in batches; returns the number of rows moved."""
+    model, archive_model = RETENTION_MODELS[table]
+    archive = archive or app.config['RETENTION_ARCHIVE']
+    batch_size = batch_size or app.config['RETENTION_BATCH_SIZE']
+    now = now or datetime.utcnow()
+    candidates = retention_candidates(table, now)
+    if candidates is None:
+        return 0
+    # run the (union + window) candidate query once, then work through the ids in short batches
+    all_ids = db.session.execute(select(candidates.c.id).order_by(candidates.c.id)).scalars().all()
+    db.session.commit()
+    moved = 0
+    for start in range(0, len(all_ids), batch_size):
+        ids = all_ids[start:start + batch_size]
+        try:
+            records = [dict(r) for r in db.session.execute(select(model.__table__).where(model.id.in_(ids))).mappings()]
+            if not records:
+                continue  # removed since the candidate query ran
+            ids = [rec['id'] for rec in records]
+            if archive == 'table':
+                db.session.execute(insert(archive_model), [{
+                    'id': rec['id'],
+                    'user_id': rec['user_id'],
+                    'created_at': rec['created_at'],
+                    'archived_at': now,
+                    'record': gzip.compress(json.dumps(rec, default=_json_default).encode('utf-8'), mtime=0),
+                } for rec in records])
+            elif archive == 'ndjson':
+                write_ndjson_archive(table, records, now)
+            db.session.execute(delete(model).where(model.id.in_(ids)))
+            if table == 'notifications':
+                for user_id, n in Counter(rec['user_id'] for rec in records if not rec['is_read']).items():
+                    bump_unread(user_id, -n)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        moved += len(records)
+    return moved
+
+def incremental_vacuum(tables=(), pages=None, enable=False):
+    """Return freed space to the OS. SQLite needs auto_vacuum=INCREMENTAL (set once with enable=True)."""
+    engine = db.engine
+    if engine.dialect.name == 'sqlite':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            if enable and conn.execute(text('PRAGMA auto_vacuum')).scalar() != 2:
+                conn.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+                conn.execute(text('VACUUM'))  # one-off full rebuild to switch modes
+            if conn.execute(text('PRAGMA auto_vacuum')).scalar() != 2:
+                return 'skipped: auto_vacuum is not INCREMENTAL (run with --enable-incremental-vacuum once)'
+            free = conn.execute(text('PRAGMA freelist_count')).scalar()
+            # sqlite3's execute() steps this pragma once (one page); executescript runs it to completion
+            conn.connection.driver_connection.executescript(
+                f"PRAGMA incremental_vacuum({int(pages or app.config['RETENTION_VACUUM_PAGES'])});")
+            return f"freed {free - conn.execute(text('PRAGMA freelist_count')).scalar()} pages"
+    if engine.dialect.name == 'postgresql':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            for table in tables:
+                conn.execute(text(f'VACUUM (ANALYZE) {table}'))
+        return f"vacuumed {', '.join(tables)}"
+    return f'skipped: no vacuum for {engine.dialect.name}'
+
+@app.cli.command('retention')
+@click.option('--dry-run', is_flag=True, help='Only report eligible rows and reclaimable space.')
+@click.option('--table', 'tables', multiple=True, type=click.Choice(list(RETENTION_MODELS)))
+@click.option('--archive', type=click.Choice(['table', 'ndjson', 'none']), default=None)
+@click.option('--batch-size', type=int, default=None)
+@click.option('--enable-incremental-vacuum', is_flag=True, help='SQLite: switch to auto_vacuum=INCREMENTAL (full VACUUM once).')
+def retention_command(dry_run, tables, archive, batch_size, enable_incremental_vacuum):
+    """Apply retention policies to sync_logs and notifications."""
+    tables = tables or tuple(RETENTION_MODELS)
+    for row in retention_report():
+        if row['table'] in tables:
+            click.echo(f"{row['table']}: {row['eligible']}/{row['rows']} rows eligible, "
+                       f"~{row['reclaimable_bytes'] if row['reclaimable_bytes'] is not None else '?'} of "
+                       f"{row['size_bytes'] if row['size_bytes'] is not None else '?'} bytes reclaimable")
+    if dry_run:
+        return
+    for table in tables:
+        click.echo(f"{table}: archived {apply_retention(table, archive=archive, batch_size=batch_size)} rows")
+    click.echo(incremental_vacuum(tables, enable=enable_incremental_vacuum))
+
+# --- Capsule reveal (bulk) ---
+# Capsules that unlock together (e.g. thousands at New Year) are revealed in batches. Each batch is
+# a single transaction of set-based statements: claim the capsules, apply their reveal_policy to
+# linked entries and memories, rebuild their public feed rows with INSERT ... SELECT and insert
+# the owners' notifications in bulk. A batch that fails is retried one capsule at a time and the
+# failing capsules are skipped until the next run.
+# Schema: capsules.reveal_policy / revealed_at were added after the table existed; db.create_all()
+# won't add them to an existing database, so run `flask upgrade-db` (or create_tables()) once.
+FEED_COLUMNS = ['source_type', 'source_id', 'author_id', 'visibility', 'is_anonymous', 'title', 'snippet', 'mood', 'location_id', 'created_at']
+
+def publish_capsule_contents(capsule_ids, policy):
+    anonymous = policy == Visibility.ANONYMOUS.value
+    for model, source_type in ((DiaryEntry, 'entry'), (Memory, 'memory')):
+        in_capsules = model.capsule_id.in_(capsule_ids)
+        db.session.execute(update(model).where(in_capsules).values(visibility=policy),
+                           execution_options={'synchronize_session': False})
+        db.session.execute(delete(PublicFeedIndex).where(
+            PublicFeedIndex.source_type == source_type,
+            PublicFeedIndex.source_id.in_(select(model.id).where(in_capsules))))
+        # same title/snippet/mood rules as push_public_feed()
+        if model is DiaryEntry:
+            snippet = case((db.func.length(DiaryEntry.content) > 500, db.func.substr(DiaryEntry.content, 1, 497) + '...'),
+                           else_=DiaryEntry.content)
+            mood = DiaryEntry.mood
+        else:
+            snippet, mood = literal(''), null()
+        rows = select(
+            literal(source_type), model.id, null() if anonymous else model.user_id, literal(policy), literal(anonymous),
+            model.title, snippet, mood, model.location_id, model.created_at,
+        ).where(in_capsules)
+        db.session.execute(insert(PublicFeedIndex).from_select(FEED_COLUMNS, rows))
+
+def reveal_capsule_batch(caps, now):
+    """Reveal one batch in a single transaction. Returns False if another worker claimed part of it."""
+    cap_ids = [c.id for c in caps]
+    try:
+        claimed = db.session.execute(
+            update(Capsule).where(Capsule.id.in_(cap_ids), Capsule.is_revealed == False)
+            .values(is_revealed=True, revealed_at=now),
+            execution_options={'synchronize_session': False}).rowcount
+        if claimed != len(cap_ids):
+            db.session.rollback()
+            return False
+        for policy in (Visibility.PUBLIC.value, Visibility.ANONYMOUS.value):
+            ids = [c.id for c in caps if c.reveal_policy == policy]
+            if ids:
+                publish_capsule_contents(ids, policy)
+        notify_many([{'user_id': c.created_by_id, 'title': 'Capsule unlocked',
+                      'body': f'Your capsule "{c.title}" was unlocked.', 'data': {'capsule_id': c.id}}
+                     for c in caps if c.created_by_id])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return True
+
+def reveal_due_capsules(now=None, batch_size=None):
+    """Reveal all capsules due at `now`; returns how many were revealed."""
+    now = now or datetime.utcnow()
+    batch_size = batch_size or app.config['CAPSULE_REVEAL_BATCH_SIZE']
+    revealed = 0
+    failed = set()  # left for the next run so they can't hold up the capsules behind them
+    while True:
+        query = select(Capsule.id, Capsule.created_by_id, Capsule.title, Capsule.reveal_policy) \
+            .where(Capsule.unlock_at <= now, Capsule.is_revealed == False)
+        if failed:
+            query = query.where(Capsule.id.not_in(failed))
+        caps = db.session.execute(query.order_by(Capsule.unlock_at, Capsule.id).limit(batch_size)).all()
+        if not caps:
+            break
+        try:
+            if reveal_capsule_batch(caps, now):
+                revealed += len(caps)
+            continue  # on a lost claim, re-select what is left
+        except Exception as e:
+            print('Error revealing capsules', caps[0].id, '-', caps[-1].id, e)
+        # fall back to one capsule per transaction to isolate the bad ones
+        for cap in caps:
+            try:
+                if reveal_capsule_batch([cap], now):
+                    revealed += 1
+            except Exception as e:
+                failed.add(cap.id)
+                print('Error revealing capsule', cap.id, e)
+    return revealed
+
+@app.cli.command('bench-capsule-reveal')
+@click.option('--capsules', default=5000, help='Capsules unlocking at the same moment.')
+@click.option('--items', default=2, help='Entries and memories linked to each capsule (each).')
+@click.option('--batch-size', type=int, default=None)
+def bench_capsule_reveal(capsules, items, batch_size):
+    """Time reveal_due_capsules() on a synthetic backlog. Use a scratch DATABASE_URL."""
+    db.create_all()
+    policies = [v.value for v in Visibility]
+    user = User(username=f'bench-{uuid.uuid4().hex[:8]}', email=f'{uuid.uuid4().hex}@bench.invalid', password_hash='!')
+    db.session.add(user)
+    db.session.flush()
+    new_year = datetime(datetime.utcnow().year, 1, 1)
+    db.session.execute(insert(Capsule), [
+        {'created_by_id': user.id, 'title': f'capsule {i}', 'unlock_at': new_year, 'is_revealed': False,
+         'reveal_policy': policies[i % 3], 'created_at': new_year} for i in range(capsules)])
+    cap_ids = db.session.execute(select(Capsule.id).where(Capsule.created_by_id == user.id)).scalars().all()
+    db.session.execute(insert(DiaryEntry), [
+        {'user_id': user.id, 'title': f'entry {cid}.{k}', 'content': 'dear future me ' * 50, 'mood': 'hopeful',
+         'visibility': Visibility.PRIVATE.value, 'capsule_id': cid, 'created_at': new_year, 'updated_at': new_year}
+        for cid in cap_ids for k in range(items)])
+    db.session.execute(insert(Memory), [
+        {'user_id': user.id, 'title': f'memory {cid}.{k}', 'description': 'photo', 'visibility': Visibility.PRIVATE.value,
+         'capsule_id': cid, 'created_at': new_year} for cid in cap_ids for k in range(items)])
+    db.session.commit()
+    started = time.perf_counter()
+    revealed = reveal_due_capsules(now=new_year, batch_size=batch_size)
+    elapsed = time.perf_counter() - started
+    published = PublicFeedIndex.query.filter(PublicFeedIndex.source_type == 'entry', PublicFeedIndex.source_id.in_(
+        select(DiaryEntry.id).where(DiaryEntry.user_id == user.id))).count()
+    click.echo(f'revealed {revealed} capsules ({capsules * items * 2} linked rows) in {elapsed:.2f}s '
+               f'= {revealed / elapsed:.0f} capsules/s; {published} entries in public feed')
+    for model, source_type in ((DiaryEntry, 'entry'), (Memory, 'memory')):
+        PublicFeedIndex.query.filter(PublicFeedIndex.source_type == source_type, PublicFeedIndex.source_id.in_(
+            select(model.id).where(model.user_id == user.id))).delete(synchronize_session=False)
+        model.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    Notification.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    NotificationCounter.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    Capsule.query.filter_by(created_by_id=user.id).delete(synchronize_session=False)
+    db.session.delete(user)
+    db.session.commit()
+
 # --- Background tasks: capsule reveal & reminders ---
 scheduler = BackgroundScheduler()
 
 def job_reveal_capsules():
     with app.app_context():
-        now = datetime.utcnow()
-        caps = Capsule.query.filter(Capsule.unlock_at <= now, Capsule.is_revealed == False).all()
-        for cap in caps:
-            try:
-                cap.is_revealed = True
-                # reveal logic: set contained diary_entries/memories visibility to user's choice
-                # simple approach: find diary_entries with cap.id and set visibility=private->private? For demo, we just notify
-                # create notification
-                if cap.created_by_id:
-                    n = Notification(user_id=cap.created_by_id, title='Capsule unlocked', body=f'Your capsule "{cap.title}" was unlocked.')
-                    db.session.add(n)
-                db.session.commit()
-                # optionally publish entries or move them public depending on additional flags (not implemented)
-            except Exception as e:
-                db.session.rollback()
-                print('Error revealing capsule', cap.id, e)
+        reveal_due_capsules()
 
 def job_run_reminders():
     with app.app_context():
@@ -701,8 +2195,7 @@ def job_run_reminders():
         for r in rems:
             try:
                 # create notification
-                n = Notification(user_id=r.user_id, title='Reminder', body=f'Reminder: {r.title}')
-                db.session.add(n)
+                notify(r.user_id, 'Reminder', f'Reminder: {r.title}')
                 # schedule next_run_at naive: add 1 day
                 r.last_run_at = now
                 r.next_run_at = now + timedelta(days=1)
@@ -711,14 +2204,77 @@ def job_run_reminders():
                 db.session.rollback()
                 print('Error running reminder', r.id, e)
 
+def job_cleanup_uploads():
+    with app.app_context():
+        try:
+            cleanup_stale_uploads()
+        except Exception as e:
+            db.session.rollback()
+            print('Error cleaning up uploads', e)
+
+def job_dedupe_locations():
+    with app.app_context():
+        try:
+            dedupe_locations()
+        except Exception as e:
+            db.session.rollback()
+            print('Error deduplicating locations', e)
+
+def job_apply_retention():
+    with app.app_context():
+        for table in RETENTION_MODELS:
+            try:
+                apply_retention(table)
+            except Exception as e:
+                db.session.rollback()
+                print('Error applying retention', table, e)
+        try:
+            incremental_vacuum(tuple(RETENTION_MODELS))
+        except Exception as e:
+            print('Error vacuuming', e)
+
 scheduler.add_job(job_reveal_capsules, 'interval', seconds=60)
 scheduler.add_job(job_run_reminders, 'interval', seconds=60)
+scheduler.add_job(job_apply_retention, 'interval', hours=24)
+scheduler.add_job(job_cleanup_uploads, 'interval', minutes=30)
+scheduler.add_job(job_dedupe_locations, 'interval', hours=24)
 scheduler.start()
 
 # --- DB init helper ---
+# columns added to tables that already existed; create_all() only creates missing tables
+ADDED_COLUMNS = [
+    ('capsules', 'reveal_policy', "VARCHAR(16) NOT NULL DEFAULT 'private'"),
+    ('capsules', 'revealed_at', 'TIMESTAMP'),
+]
+# indexes added to tables that already existed, by model and index name
+ADDED_INDEXES = [
+    (SyncLog, 'ix_sync_logs_user_id'),
+    (Notification, 'ix_notifications_user_delivered'),
+    (Memory, 'ix_memories_capsule_id'),
+    (Location, 'ix_locations_lat_lon'),
+]
+
+def upgrade_schema():
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table, column, ddl in ADDED_COLUMNS:
+            if table in inspector.get_table_names() and column not in {c['name'] for c in inspector.get_columns(table)}:
+                conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+        for model, name in ADDED_INDEXES:
+            index = next(ix for ix in model.__table__.indexes if ix.name == name)
+            index.create(conn, checkfirst=True)
+
 def create_tables():
     with app.app_context():
         db.create_all()
+        upgrade_schema()
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables and add columns and indexes introduced since the database was created."""
+    db.create_all()
+    upgrade_schema()
+    click.echo('schema up to date')
 
 # --- Run ---
 if __name__ == '__main__':